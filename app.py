@@ -1,17 +1,74 @@
-import os, json, traceback, requests, time
-from flask import Flask, request, jsonify, make_response
-from typing import List, Dict, Any, Optional, Tuple
+try:
+    # must run before requests/ssl are imported so BL waits yield to other greenlets
+    from gevent import monkey; monkey.patch_all()
+except ImportError:
+    pass
+import os, re, json, traceback, requests, time, logging, uuid, threading, atexit, itertools
+from flask import Flask, Response, request, jsonify, make_response, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Set, FrozenSet, Callable
 from io import StringIO
 import csv
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util.request import ACCEPT_ENCODING
+try:
+    import orjson  # much faster (de)serialization of big getOrders/product pages
+except ImportError:
+    orjson = None
+try:
+    import fcntl  # cross-worker lock for rewriting the cache file and invalidation log
+except ImportError:
+    fcntl = None
 
 # ==== Config ====
 BL_API_URL = "https://api.baselinker.com/connector.php"
 BL_TOKEN = os.environ.get("BL_TOKEN")
 SHARED_KEY = os.environ.get("BL_SHARED_KEY", "")
 WAREHOUSE_ID = os.environ.get("BL_WAREHOUSE_ID", "77617")  # your warehouse
+
+def _env_int(raw: Optional[str]) -> Optional[int]:
+    # parsed once at import; a malformed value must not stop the module (and /health) loading
+    try: return int(raw)
+    except (TypeError, ValueError): return None
+
+_WAREHOUSE_ID_INT = _env_int(WAREHOUSE_ID)  # checked by require_warehouse_id()
+_INVENTORY_ID = _env_int(os.environ.get("INVENTORY_ID"))  # checked by require_catalog_id()
 TIMEOUT = 30
+DEBUG = (os.environ.get("BL_DEBUG") or "").strip().lower() in ("1","true","yes")
+
+LOG_LEVEL = (os.environ.get("LOG_LEVEL") or "INFO").strip().upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):  # unknown names map to "Level X"
+    LOG_LEVEL = "INFO"
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger("bl")
+
+# shared pool for overlapping independent BL round-trips
+_POOL = ThreadPoolExecutor(max_workers=8)
+
+def _dumps(obj: Any) -> str:
+    return orjson.dumps(obj).decode() if orjson else json.dumps(obj)
+
+def _loads(raw: bytes) -> Any:
+    return orjson.loads(raw) if orjson else json.loads(raw)
+
+class OrjsonProvider(DefaultJSONProvider):
+    # jsonify() through orjson; keeps Flask's sorted keys and allows int keys (e.g. modes_used)
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS,
+                            default=self.default).decode()
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return orjson.loads(s)
 
 app = Flask(__name__)
+if orjson:
+    app.json = OrjsonProvider(app)
 
 # --- sanity routes ---
 @app.get("/")
@@ -20,9 +77,26 @@ def root():
 
 @app.get("/health")
 def health():
-    # unmistakable marker so you know this build is live
+    # unmistakable marker so you know this build is live (GET/HEAD are served by HealthMiddleware)
     return jsonify({"ok": True, "version": "health v2 - hardcoded"})
 
+class HealthMiddleware:
+    """Answer GET /health before Flask builds a request context (LB probes hit it constantly)."""
+    BODY = b'{"ok":true,"version":"health v2 - hardcoded"}\n'
+    HEADERS = [("Content-Type", "application/json"), ("Content-Length", str(len(BODY)))]
+
+    def __init__(self, wsgi_app):
+        self.app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        method = environ.get("REQUEST_METHOD")
+        if environ.get("PATH_INFO") in ("/health", "/health/") and method in ("GET", "HEAD"):
+            start_response("200 OK", self.HEADERS)
+            return [self.BODY] if method == "GET" else []
+        return self.app(environ, start_response)
+
+app.wsgi_app = HealthMiddleware(app.wsgi_app)
+
 @app.get("/__routes")
 def list_routes():
     output = []
@@ -33,164 +107,885 @@ def list_routes():
 
 # ==== Helpers ====
 
+# one keep-alive pool for every BL call instead of a TLS handshake per request.
+# POST is not in Retry's default allowed_methods, so only connect failures are retried
+# (a 5xx on addInventoryDocument must not create a second document).
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16, pool_maxsize=100,  # matches gunicorn worker_connections
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504]),
+))
+# explicit so a proxy/env default can't drop it; big JSON pages compress well.
+# urllib3 adds br only when a brotli decoder is importable
+_SESSION.headers["Accept-Encoding"] = ACCEPT_ENCODING
+_encoding_logged = False
+if BL_TOKEN:
+    _SESSION.headers["X-BLToken"] = BL_TOKEN
+
 def http_error(status: int, msg: str, detail: str = ""):
     payload = {"error": msg}
     if detail:
         payload["detail"] = detail
     return make_response(jsonify(payload), status)
 
-def bl_call(method: str, params: dict) -> dict:
+def internal_error(e: Exception):
+    # traceback goes to the log; the client only gets an id to grep for
+    if isinstance(e, BLUnavailable):
+        return http_error(503, "BaseLinker unavailable", detail=str(e))
+    eid = uuid.uuid4().hex[:8]
+    log.exception("%s failed (err %s)", request.endpoint, eid)
+    detail = f"{eid}: {e.__class__.__name__}: {e}"
+    if DEBUG or app.debug:
+        detail += "\n" + traceback.format_exc()
+    return http_error(500, "Internal error", detail=detail)
+
+class TokenBucket:
+    """Client-side pacing so bursts queue here instead of tripping BL's per-minute limit."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.stamp = capacity, time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+BL_RATE_PER_MIN = float(os.environ.get("BL_RATE_PER_MIN", "100"))  # BL allows 100/min per token
+BL_RATE_BURST = float(os.environ.get("BL_RATE_BURST", "20"))
+# both limits are for the whole deployment; every worker process gets an equal share
+# (WEB_CONCURRENCY, same default as gunicorn.conf.py)
+_WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", "2")))
+_BUCKET = TokenBucket(rate=BL_RATE_PER_MIN / 60 / _WORKERS, capacity=max(1.0, BL_RATE_BURST / _WORKERS))
+
+class BLUnavailable(RuntimeError):
+    """BL calls are being short-circuited; routes answer 503."""
+
+class CircuitBreaker:
+    """Fail fast while BL is down instead of parking every worker on TIMEOUT-long calls."""
+
+    def __init__(self, fail_max: int, reset_timeout: float):
+        self.fail_max, self.reset_timeout = fail_max, reset_timeout
+        self.fails, self.opened_at = 0, None
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            # half-open: this caller probes BL, everyone else keeps failing fast meanwhile
+            self.opened_at = time.monotonic()
+            return True
+
+    def success(self) -> None:
+        with self.lock:
+            self.fails, self.opened_at = 0, None
+
+    def failure(self) -> None:
+        with self.lock:
+            self.fails += 1
+            if self.fails >= self.fail_max:
+                if self.opened_at is None:
+                    log.warning("BL circuit open after %d consecutive failures", self.fails)
+                self.opened_at = time.monotonic()
+
+BL_MAX_INFLIGHT = int(os.environ.get("BL_MAX_INFLIGHT", "32"))
+_BL_SEM = threading.BoundedSemaphore(BL_MAX_INFLIGHT)
+_BREAKER = CircuitBreaker(fail_max=10, reset_timeout=30)
+
+BL_LIMIT_RETRIES = 3
+BL_LIMIT_BACKOFF = 1.0  # seconds, doubled per retry; stays well inside the worker timeout
+
+def _is_rate_limited(j: Any) -> bool:
+    # BL answers HTTP 200 with status=ERROR; the limit shows up in error_code/error_message
+    if not isinstance(j, dict) or j.get("status") != "ERROR":
+        return False
+    return "limit" in f"{j.get('error_code') or ''} {j.get('error_message') or ''}".lower()
+
+def bl_call_raw(data: Dict[str, str]) -> dict:
+    """POST a prebuilt {"method", "parameters"} body (parameters already JSON-encoded)."""
     if not BL_TOKEN:
         raise RuntimeError("BL_TOKEN not set")
-    headers = {"X-BLToken": BL_TOKEN}
-    data = {"method": method, "parameters": json.dumps(params)}
-    r = requests.post(BL_API_URL, headers=headers, data=data, timeout=TIMEOUT)
-    r.raise_for_status()
-    j = r.json()
+    global _encoding_logged
+    for attempt in range(BL_LIMIT_RETRIES + 1):
+        if not _BREAKER.allow():
+            raise BLUnavailable(f"BL circuit open; {data['method']} not sent")
+        _BUCKET.acquire()
+        try:
+            with _BL_SEM:
+                r = _SESSION.post(BL_API_URL, data=data, timeout=TIMEOUT)
+            r.raise_for_status()
+        except requests.RequestException:
+            _BREAKER.failure()
+            raise
+        _BREAKER.success()
+        if not _encoding_logged:
+            _encoding_logged = True
+            log.info("BL Content-Encoding: %s", r.headers.get("Content-Encoding") or "identity")
+        j = _loads(r.content)
+        if not _is_rate_limited(j) or attempt == BL_LIMIT_RETRIES:
+            break
+        wait = BL_LIMIT_BACKOFF * 2 ** attempt
+        log.warning("BL rate limit on %s; retry %d in %.1fs", data["method"], attempt + 1, wait)
+        time.sleep(wait)
+    if _is_rate_limited(j):
+        raise RuntimeError(f"BL API rate limit in {data['method']}: {j.get('error_message') or j.get('error_code')}")
     if isinstance(j, dict) and j.get("error"):
-        raise RuntimeError(f"BL API error in {method}: {j['error']}")
+        raise RuntimeError(f"BL API error in {data['method']}: {j['error']}")
     return j
 
+def bl_call(method: str, params: Optional[dict] = None, params_json: Optional[str] = None) -> dict:
+    # params_json lets hot loops pass parameters they have already encoded
+    if params_json is None:
+        params_json = _dumps(params or {})
+    return bl_call_raw({"method": method, "parameters": params_json})
+
+# fixed-shape bodies, encoded once at import
+_P_LOCATIONS = {"method": "getInventoryLocations", "parameters": _dumps({"warehouse_id": _WAREHOUSE_ID_INT})}
+
 def require_catalog_id() -> int:
-    inv = os.environ.get("INVENTORY_ID")
-    if not inv:
+    if _INVENTORY_ID is None:
+        if os.environ.get("INVENTORY_ID"):
+            raise RuntimeError("INVENTORY_ID is not an integer")
         raise RuntimeError("INVENTORY_ID not set")
-    return int(inv)
+    return _INVENTORY_ID
+
+def require_warehouse_id() -> int:
+    if _WAREHOUSE_ID_INT is None:
+        raise RuntimeError("BL_WAREHOUSE_ID is not an integer")
+    return _WAREHOUSE_ID_INT
 
 def to_int(x) -> int:
     try: return int(x or 0)
     except: return 0
 
+def _norm_item(it: Dict[str, Any]) -> Tuple[str, str, int]:
+    """Order line -> (sku, ean, qty) in one pass."""
+    sku = it.get("sku") or it.get("product_sku") or ""
+    ean = it.get("ean") or it.get("product_ean") or ""
+    qty = it.get("quantity") or it.get("qty") or 0
+    if type(qty) is not int:
+        qty = to_int(qty)
+    return str(sku).strip(), str(ean).strip(), qty
+
+# ==== Lookup cache (persisted across restarts) ====
+
+CACHE_FILE = os.environ.get("BL_CACHE_FILE", "/tmp/bl_cache.json")
+CACHE_FLUSH_EVERY = 50   # writes between flushes to disk
+CACHE_MAX_ENTRIES = int(os.environ.get("BL_CACHE_MAX", "50000"))  # oldest writes are evicted past this
+CATALOG_TTL = 24 * 3600  # sku/ean -> product_id rarely changes
+
+CACHE: Dict[str, Dict[str, Any]] = {}  # key -> {"exp": unix ts, "v": value}
+_cache_lock = threading.Lock()
+_cache_dirty = 0
+
+def _cache_read_file() -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(CACHE_FILE, "rb") as f:
+            data = _loads(f.read())
+    except Exception:
+        return {}
+    now = time.time()
+    return {k: e for k, e in data.items() if isinstance(e, dict) and e.get("exp", 0) > now}
+
+def _cache_load() -> None:
+    CACHE.update(_cache_read_file())
+
+def _cache_prune_locked(now: float, entries: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+    # caller holds _cache_lock (for CACHE); expired entries go first, then the oldest writes
+    entries = CACHE if entries is None else entries
+    for k in [k for k, e in entries.items() if e["exp"] <= now]:
+        del entries[k]
+    excess = len(entries) - CACHE_MAX_ENTRIES
+    if excess > 0:
+        for k in list(itertools.islice(entries, excess)):
+            del entries[k]
+
+@contextmanager
+def _cache_file_lock() -> Iterator[None]:
+    # held by one worker at a time while it rewrites CACHE_FILE or touches the invalidation log
+    try:
+        f = open(f"{CACHE_FILE}.lock", "a")
+    except OSError:
+        f = None
+    try:
+        if f is not None and fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+    finally:
+        if f is not None:
+            f.close()  # releases the flock
+
+def _cache_flush() -> None:
+    global _cache_dirty
+    with _cache_file_lock():
+        _cache_sync(force=True)  # never write back entries another worker invalidated
+        with _cache_lock:
+            _cache_prune_locked(time.time())
+            snap = dict(CACHE)
+            _cache_dirty = 0
+            dropped = tuple(_inval_applied)
+            _inval_applied.clear()
+        # every worker flushes into the same file: keep the others' entries unless ours are
+        # newer or a prefix invalidated since our last flush covers them
+        merged = {k: e for k, e in _cache_read_file().items() if not k.startswith(dropped)}
+        for k, e in snap.items():
+            if k not in merged or e["exp"] >= merged[k]["exp"]:
+                merged.pop(k, None)
+                merged[k] = e
+        _cache_prune_locked(time.time(), merged)
+        tmp = f"{CACHE_FILE}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(_dumps(merged))
+            os.replace(tmp, CACHE_FILE)
+        except Exception:
+            log.warning("cache flush to %s failed", CACHE_FILE, exc_info=True)
+            return
+        _inval_compact()
+
+def cache_get(key: str) -> Any:
+    _cache_sync()
+    e = CACHE.get(key)
+    if e is None:
+        return None
+    if e["exp"] <= time.time():
+        CACHE.pop(key, None)
+        return None
+    return e["v"]
+
+def cache_set(key: str, value: Any, ttl: float) -> None:
+    global _cache_dirty
+    with _cache_lock:
+        CACHE.pop(key, None)  # re-insert so eviction order follows the latest write
+        CACHE[key] = {"exp": time.time() + ttl, "v": value}
+        if len(CACHE) > CACHE_MAX_ENTRIES:
+            _cache_prune_locked(time.time())
+        _cache_dirty += 1
+        due = _cache_dirty >= CACHE_FLUSH_EVERY
+    if due:
+        _cache_flush()
+
+def cache_set_many(pairs: Dict[str, Any], ttl: float) -> None:
+    # counts as a single write toward the flush threshold
+    global _cache_dirty
+    if not pairs:
+        return
+    exp = time.time() + ttl
+    with _cache_lock:
+        for k, v in pairs.items():
+            CACHE.pop(k, None)
+            CACHE[k] = {"exp": exp, "v": v}
+        if len(CACHE) > CACHE_MAX_ENTRIES:
+            _cache_prune_locked(time.time())
+        _cache_dirty += 1
+        due = _cache_dirty >= CACHE_FLUSH_EVERY
+    if due:
+        _cache_flush()
+
+# Each gunicorn worker holds its own CACHE/_catalog_lru. Invalidations are appended to this
+# shared log ("<ts>\t<prefix>" per line) and every worker replays the bytes past its last read
+# offset on its next cache access, so a flush reaches all workers and none writes stale entries
+# back. A flush rewrites the log once it grows past CACHE_INVAL_COMPACT_BYTES; the new file's
+# "#gen" header tells the other workers to reload the cache file rather than resume their offset.
+CACHE_INVALIDATIONS = f"{CACHE_FILE}.inval"
+CACHE_INVAL_COMPACT_BYTES = 64 * 1024
+CACHE_SYNC_EVERY = 1.0  # seconds between checks of the invalidation log
+_inval_gen = ""     # "#gen" header of the log generation being followed
+_inval_off = 0      # bytes of that generation already replayed
+_inval_sig: Tuple[int, int] = (0, 0)  # (mtime_ns, size) at the last read
+_inval_checked = 0.0
+_inval_applied: List[str] = []  # prefixes dropped since the last flush; also purged from CACHE_FILE
+
+def _drop_prefix(prefix: str) -> int:
+    with _cache_lock:
+        doomed = [k for k in CACHE if k.startswith(prefix)]
+        for k in doomed:
+            del CACHE[k]
+        _inval_applied.append(prefix)
+    if not prefix or prefix.startswith(("sku:", "ean:")):
+        with _catalog_lru_lock:
+            _catalog_lru.clear()
+    return len(doomed)
+
+def _inval_header(gen: str) -> str:
+    return f"#gen {gen}\n"
+
+def _inval_gen_of(first_line: bytes) -> str:
+    # "" for a log that was started by an append and never compacted
+    return first_line[5:].strip().decode() if first_line.startswith(b"#gen ") else ""
+
+def _cache_sync(force: bool = False) -> None:
+    """Replay invalidations other workers published since this one last looked."""
+    global _inval_gen, _inval_off, _inval_sig, _inval_checked
+    now = time.time()
+    if not force and now - _inval_checked < CACHE_SYNC_EVERY:
+        return
+    _inval_checked = now
+    try:
+        st = os.stat(CACHE_INVALIDATIONS)
+        sig = (st.st_mtime_ns, st.st_size)
+        if sig == _inval_sig:
+            return
+        with open(CACHE_INVALIDATIONS, "rb") as f:
+            head = f.readline()
+            gen = _inval_gen_of(head)
+            if gen != _inval_gen:
+                # compacted by another worker, whose flush already applied every line we
+                # may have missed to CACHE_FILE: start over from that file
+                with _cache_lock:
+                    CACHE.clear()
+                with _catalog_lru_lock:
+                    _catalog_lru.clear()
+                _cache_load()
+                _inval_gen, _inval_off = gen, f.tell() if gen else 0
+            f.seek(_inval_off)
+            data = f.read()
+    except OSError:
+        return
+    _inval_sig = sig
+    end = data.rfind(b"\n") + 1  # a line still being appended is picked up next time
+    _inval_off += end
+    for line in data[:end].decode(errors="replace").splitlines():
+        ts, sep, prefix = line.partition("\t")
+        if sep:
+            _drop_prefix(prefix)
+
+def _inval_compact() -> None:
+    # caller holds _cache_file_lock and has just synced and flushed, so CACHE_FILE
+    # reflects every line of the current log
+    global _inval_gen, _inval_off, _inval_sig
+    if _inval_off < CACHE_INVAL_COMPACT_BYTES:
+        return
+    gen = uuid.uuid4().hex
+    tmp = f"{CACHE_INVALIDATIONS}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            f.write(_inval_header(gen))
+        os.replace(tmp, CACHE_INVALIDATIONS)
+        st = os.stat(CACHE_INVALIDATIONS)
+    except OSError:
+        log.warning("could not compact %s", CACHE_INVALIDATIONS, exc_info=True)
+        return
+    _inval_gen, _inval_off, _inval_sig = gen, len(_inval_header(gen)), (st.st_mtime_ns, st.st_size)
+
+def cache_invalidate(prefix: str = "") -> int:
+    """Drop keys starting with `prefix` in this worker and, via the log, in all others."""
+    global _inval_off, _inval_sig
+    prefix = prefix.replace("\t", "").replace("\n", "")
+    line = f"{time.time():.6f}\t{prefix}\n".encode()
+    with _cache_file_lock():
+        _cache_sync(force=True)
+        try:
+            with open(CACHE_INVALIDATIONS, "ab") as f:
+                f.write(line)
+            st = os.stat(CACHE_INVALIDATIONS)
+        except OSError:
+            log.warning("could not publish cache invalidation to %s", CACHE_INVALIDATIONS, exc_info=True)
+        else:
+            # nothing else can append under the lock: our own line needn't be replayed
+            _inval_off, _inval_sig = _inval_off + len(line), (st.st_mtime_ns, st.st_size)
+    n = _drop_prefix(prefix)
+    _cache_flush()
+    return n
+
+def _inval_skip_to_end() -> None:
+    # at import: lines already in the log are reflected in CACHE_FILE, so follow from its end
+    global _inval_gen, _inval_off, _inval_sig
+    try:
+        st = os.stat(CACHE_INVALIDATIONS)
+        with open(CACHE_INVALIDATIONS, "rb") as f:
+            head = f.readline()
+    except OSError:
+        return
+    _inval_gen = _inval_gen_of(head)
+    _inval_off, _inval_sig = st.st_size, (st.st_mtime_ns, st.st_size)
+
+_cache_load()
+_inval_skip_to_end()
+def _cache_flush_at_exit() -> None:
+    # a process with nothing unsaved (e.g. the preloading gunicorn master) must not write
+    # its pre-fork snapshot over what the workers flushed
+    if _cache_dirty:
+        _cache_flush()
+
+atexit.register(_cache_flush_at_exit)
+
 # ==== Product / ERP helpers ====
 
+CATALOG_LRU_SIZE = 4096
+CATALOG_REC_TTL = 120  # full records (locations/stock) go stale faster than ids
+
+_catalog_lru: "OrderedDict[Tuple[str, Tuple[str, ...]], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_catalog_lru_lock = threading.Lock()
+
+def _catalog_lru_get(k: Tuple[str, Tuple[str, ...]]) -> Optional[Dict[str, Any]]:
+    _cache_sync()
+    with _catalog_lru_lock:
+        hit = _catalog_lru.get(k)
+        if hit is None:
+            return None
+        if time.monotonic() - hit[0] > CATALOG_REC_TTL:
+            del _catalog_lru[k]
+            return None
+        _catalog_lru.move_to_end(k)
+        return dict(hit[1])  # callers get their own copy
+
+def _catalog_lru_put(k: Tuple[str, Tuple[str, ...]], rec: Dict[str, Any]) -> None:
+    with _catalog_lru_lock:
+        _catalog_lru[k] = (time.monotonic(), dict(rec))
+        _catalog_lru.move_to_end(k)
+        while len(_catalog_lru) > CATALOG_LRU_SIZE:
+            _catalog_lru.popitem(last=False)
+
 def find_catalog_product(sku: Optional[str] = None, ean: Optional[str] = None, include: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
     inv_id = require_catalog_id()
     if sku:
-        params = {"inventory_id": inv_id, "filter_sku": sku}
+        params, key = {"inventory_id": inv_id, "filter_sku": sku}, f"sku:{sku}"
     elif ean:
-        params = {"inventory_id": inv_id, "filter_ean": ean}
+        params, key = {"inventory_id": inv_id, "filter_ean": ean}, f"ean:{ean}"
     else:
         return None
+    lru_key = (key, tuple(include or ()))
+    rec = _catalog_lru_get(lru_key)
+    if rec is not None:
+        return rec
     if include:
         params["include"] = include
+    else:
+        # id-only lookups can be answered from the cache
+        pid = cache_get(key)
+        if pid is not None:
+            return {"product_id": pid}
     resp = bl_call("getInventoryProductsList", params)
-    prods = resp.get("products", {}) or {}
-    for pid_str, pdata in prods.items():
-        pdata = dict(pdata)
-        pdata["product_id"] = int(pid_str)
-        return pdata
+    # a filter_sku/filter_ean call matches at most one product; the parsed response is ours to mutate
+    first = next(iter((resp.get("products") or {}).items()), None)
+    if first is None:
+        return None
+    pid_str, pdata = first
+    pdata["product_id"] = int(pid_str)
+    cache_set(key, pdata["product_id"], CATALOG_TTL)
+    _catalog_lru_put(lru_key, pdata)
+    return pdata
+
+CATALOG_WARM_MAX_PAGES = 50  # getInventoryProductsList returns up to 1000 products per page
+CATALOG_WARM_MAX_KEYS = CACHE_MAX_ENTRIES // 2  # leave the rest of the cache to ord:/loc:/igr: entries
+
+def warm_catalog_ids(max_pages: int = CATALOG_WARM_MAX_PAGES) -> Tuple[int, bool]:
+    """
+    Sweep the unfiltered product list into the sku:/ean: id cache.
+    Stops once CATALOG_WARM_MAX_KEYS keys are written, so the warm never evicts its own
+    entries; returns (products cached, whether the whole catalog fit).
+    """
+    inv_id = require_catalog_id()
+    max_pages = max(1, min(max_pages, CATALOG_WARM_MAX_PAGES))
+    seen = keys = 0
+    for page in range(1, max_pages + 1):
+        prods = bl_call("getInventoryProductsList", {"inventory_id": inv_id, "page": page}).get("products") or {}
+        if not prods:
+            return seen, True
+        pairs = {}
+        for pid_str, p in prods.items():
+            pid = to_int(pid_str)
+            sku, ean = str(p.get("sku") or "").strip(), str(p.get("ean") or "").strip()
+            new = {}
+            if sku:
+                new[f"sku:{sku}"] = pid
+            if ean:
+                new[f"ean:{ean}"] = pid
+            if keys + len(pairs) + len(new) > CATALOG_WARM_MAX_KEYS:
+                cache_set_many(pairs, CATALOG_TTL)
+                return seen, False
+            pairs.update(new)
+            seen += 1
+        cache_set_many(pairs, CATALOG_TTL)
+        keys += len(pairs)
+    return seen, False
+
+def resolve_catalog_product(sku: str, ean: str, include: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+    """
+    SKU match wins, EAN is the fallback. With both identifiers the two lookups
+    run concurrently so a SKU miss doesn't cost a second serial round-trip.
+    """
+    if sku and ean:
+        # a cached SKU answer makes the speculative EAN lookup pointless
+        rec = _catalog_lru_get((f"sku:{sku}", tuple(include or ())))
+        if rec is not None:
+            return rec
+        f_ean = _POOL.submit(find_catalog_product, ean=ean, include=include)
+        rec = find_catalog_product(sku=sku, include=include)
+        if rec:
+            f_ean.cancel()
+            return rec
+        return f_ean.result()
+    if sku:
+        return find_catalog_product(sku=sku, include=include)
+    if ean:
+        return find_catalog_product(ean=ean, include=include)
     return None
 
+def product_bins(rec: Dict[str, Any]) -> Set[str]:
+    """
+    Bin names a catalog record lists under `locations` (include=["locations"]) for our
+    warehouse. Accepts the {"bl_<warehouse_id>": "A-1,B-2"} map as well as a list of names/dicts.
+    """
+    locs = rec.get("locations") or {}
+    vals = [locs.get(f"bl_{_WAREHOUSE_ID_INT}")] if isinstance(locs, dict) else locs
+    names = set()
+    for v in vals:
+        if isinstance(v, dict):
+            v = v.get("location") or v.get("name") or ""
+        names.update(n.strip() for n in str(v or "").split(",") if n.strip())
+    return names
+
+def resolve_catalog_products_bulk(keys: List[Tuple[str, str]], include: Optional[List[str]] = None) -> Dict[Tuple[str, str], Optional[Dict[str, Any]]]:
+    """
+    Resolve many (sku, ean) pairs at once. getInventoryProductsList filters on a
+    single sku/ean, so unique SKUs are looked up concurrently, then EANs for the misses.
+    """
+    keys = list(dict.fromkeys(keys))
+    if len(keys) <= 1:
+        return {k: resolve_catalog_product(k[0], k[1], include=include) for k in keys}
+    skus = list(dict.fromkeys(sku for sku, _ in keys if sku))
+    by_sku = dict(zip(skus, _POOL.map(lambda s: find_catalog_product(sku=s, include=include), skus)))
+    eans = list(dict.fromkeys(ean for sku, ean in keys if ean and not by_sku.get(sku)))
+    by_ean = dict(zip(eans, _POOL.map(lambda e: find_catalog_product(ean=e, include=include), eans)))
+    return {(sku, ean): by_sku.get(sku) or by_ean.get(ean) for sku, ean in keys}
+
+def _request_memo(name: str) -> Optional[Dict[Any, Any]]:
+    """Dict stored on flask.g under `name`, or None outside a request."""
+    if not has_request_context():
+        return None
+    memo = g.get(name)
+    if memo is None:
+        memo = {}
+        setattr(g, name, memo)
+    return memo
+
+def _expiry_key(u: Dict[str, Any]) -> str:
+    return u["expiry_date"] or "9999-12-31"  # undated units go last
+
+def _norm_erp_units(pdata: Dict[str, Any]) -> List[Dict[str, Any]]:
+    norm = [{
+        "price": u.get("price"),
+        "expiry_date": u.get("expiry_date"),
+        "batch": u.get("batch"),
+        "qty": to_int(u.get("quantity") or u.get("qty")),
+    } for u in (pdata.get("erp_units") or [])]
+    if len(norm) > 1:  # most products carry zero or one unit
+        norm.sort(key=_expiry_key)
+    return norm
+
 def get_erp_units_for_product(pid: int) -> List[Dict[str, Any]]:
-    """Return ERP (batch) units with price/expiry/batch/qty; earliest expiry first."""
+    """Return ERP (batch) units with price/expiry/batch/qty; earliest expiry first. Memoized per request."""
+    memo, pid = _request_memo("bl_erp_units"), int(pid)
+    if memo is not None and pid in memo:
+        return memo[pid]
     inv_id = require_catalog_id()
     resp = bl_call("getInventoryProductsData", {
         "inventory_id": inv_id,
-        "products": [int(pid)],
+        "products": [pid],
         "include_erp_units": True
     })
-    pdata = (resp.get("products") or {}).get(str(pid)) or {}
-    units = pdata.get("erp_units") or []
-    norm = []
-    for u in units:
-        norm.append({
-            "price": u.get("price"),
-            "expiry_date": u.get("expiry_date"),
-            "batch": u.get("batch"),
-            "qty": to_int(u.get("quantity") or u.get("qty")),
-        })
-    norm.sort(key=lambda u: (u["expiry_date"] or "9999-12-31"))
+    norm = _norm_erp_units((resp.get("products") or {}).get(str(pid)) or {})
+    if memo is not None:
+        memo[pid] = norm
     return norm
 
+ERP_BULK_CHUNK = 1000  # getInventoryProductsData product ids per call
+
+def get_erp_units_bulk(pids: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+    """ERP units for many products in one getInventoryProductsData call per chunk; fills the request memo."""
+    memo = _request_memo("bl_erp_units")
+    out: Dict[int, List[Dict[str, Any]]] = {}
+    todo = []
+    for pid in dict.fromkeys(int(p) for p in pids):
+        if memo is not None and pid in memo:
+            out[pid] = memo[pid]
+        else:
+            todo.append(pid)
+    inv_id = require_catalog_id() if todo else None
+    for i in range(0, len(todo), ERP_BULK_CHUNK):
+        chunk = todo[i:i + ERP_BULK_CHUNK]
+        resp = bl_call("getInventoryProductsData", {
+            "inventory_id": inv_id,
+            "products": chunk,
+            "include_erp_units": True
+        })
+        products = resp.get("products") or {}
+        for pid in chunk:
+            out[pid] = _norm_erp_units(products.get(str(pid)) or {})
+            if memo is not None:
+                memo[pid] = out[pid]
+    return out
+
+def _fetch_doc_items(doc_id: int) -> Optional[List[Dict[str, Any]]]:
+    try:
+        return bl_call("getInventoryDocumentItems", {"document_id": doc_id}).get("items") or []
+    except Exception:
+        return None  # skipped like an unreadable document; not memoized
+
+def _doc_ts(d: Dict[str, Any]) -> int:
+    return to_int(d.get("date_add") or d.get("date"))
+
+def igr_docs_with_items(rows: List[Dict[str, Any]], keep: Optional[Callable[[Dict[str, Any]], bool]] = None,
+                        failed: Optional[List[int]] = None
+                        ) -> Iterator[Tuple[Dict[str, Any], int, List[Dict[str, Any]]]]:
+    """
+    (document, document_id, items) for the IGRs in one getInventoryDocumentsList page,
+    in page order; `keep` drops documents before their items are fetched.
+    Items of all IGRs on the page are fetched concurrently; documents are immutable once
+    listed, so they are memoized for the rest of the request. Documents whose items
+    couldn't be read are skipped and, if given, appended to `failed` as they are passed.
+    """
+    igr = []
+    for d in rows:
+        try:
+            if int(d.get("document_type")) == 1 and (keep is None or keep(d)):  # IGR
+                igr.append((d, int(d.get("document_id"))))
+        except Exception:
+            pass
+    memo = _request_memo("bl_doc_items")
+    todo = [doc_id for _, doc_id in igr if memo is None or doc_id not in memo]
+    if len(todo) > 1:
+        fetched = dict(zip(todo, _POOL.map(_fetch_doc_items, todo)))
+    else:
+        fetched = {doc_id: _fetch_doc_items(doc_id) for doc_id in todo}
+    for d, doc_id in igr:
+        items = fetched[doc_id] if doc_id in fetched else memo[doc_id]
+        if items is None:
+            if failed is not None:
+                failed.append(doc_id)
+            continue
+        if memo is not None:
+            memo[doc_id] = items
+        yield d, doc_id, items
+
+IGR_UNIT_TTL = 600  # seconds; the last IGR is only a price/expiry/batch hint
+
 def fetch_last_igr_unit(pid: int, lookback_days: int = 60) -> Optional[Dict[str, Any]]:
     """
     Fallback: find the latest IGR (document_type=1) item for this product in this warehouse,
     and return {expiry_date, price, batch}.
     """
+    memo, pid = _request_memo("bl_last_igr"), int(pid)
+    if memo is not None and (pid, lookback_days) in memo:
+        return memo[(pid, lookback_days)]
+    key = f"igr:{pid}:{lookback_days}"
+    hit = cache_get(key)
+    if hit is not None:
+        return hit or None  # {} = looked, none found
     inv_id = require_catalog_id()
     since = int(time.time()) - lookback_days * 24 * 3600
     page = 1
     latest = None
+    failed: List[int] = []  # unreadable documents
+    listed = True  # False once a document list page was rejected
     while page <= 10:
         docs = bl_call("getInventoryDocumentsList", {
             "inventory_id": inv_id,
-            "warehouse_id": int(WAREHOUSE_ID),
+            "warehouse_id": require_warehouse_id(),
             "date_from": since,
             "page": page
         })
+        if docs.get("status") == "ERROR":
+            listed = False
+            break
         rows = docs.get("documents", []) or []
         if not rows:
             break
-        for d in rows:
-            try:
-                if int(d.get("document_type")) != 1:  # IGR
-                    continue
-                doc_id = int(d.get("document_id"))
-                items = bl_call("getInventoryDocumentItems", {"document_id": doc_id})
-                for it in (items.get("items") or []):
-                    if int(it.get("product_id", 0)) == int(pid):
-                        stamp = to_int(d.get("date_add") or d.get("date"))
-                        rec = {
-                            "doc_id": doc_id,
-                            "ts": stamp,
-                            "expiry_date": it.get("expiry_date"),
-                            "price": it.get("price"),
-                            "batch": it.get("batch") or "",
-                        }
-                        if (latest is None) or (rec["ts"] > latest["ts"]):
-                            latest = rec
-            except Exception:
-                pass
+        # newest first: the first IGR holding the product is this page's best, and
+        # documents no newer than the best so far aren't fetched at all
+        rows.sort(key=_doc_ts, reverse=True)
+        newer = lambda d: latest is None or _doc_ts(d) > latest["ts"]
+        for d, doc_id, items in igr_docs_with_items(rows, keep=newer, failed=failed):
+            it = next((it for it in items if to_int(it.get("product_id")) == pid), None)
+            if it is not None:
+                latest = {
+                    "doc_id": doc_id,
+                    "ts": _doc_ts(d),
+                    "expiry_date": it.get("expiry_date"),
+                    "price": it.get("price"),
+                    "batch": it.get("batch") or "",
+                }
+                break
         page += 1
+    found = None
     if latest:
-        return {"expiry_date": latest["expiry_date"], "price": latest["price"], "batch": latest["batch"]}
-    return None
-
-def fetch_fifo_cost(pid: int, location_name: Optional[str] = None, lookback_days: int = 720) -> Optional[str]:
+        found = {"expiry_date": latest["expiry_date"], "price": latest["price"], "batch": latest["batch"]}
+    if listed and not failed:  # a transient BL failure must not hide the hint for IGR_UNIT_TTL
+        cache_set(key, found or {}, IGR_UNIT_TTL)
+    if memo is not None:
+        memo[(pid, lookback_days)] = found
+    return found
+
+def fetch_fifo_costs(pids: List[int], location_name: Optional[str] = None, lookback_days: int = 720) -> Dict[int, Optional[str]]:
     """
-    FIFO price = earliest IGR price for this product (optionally filtered by bin name).
-    Returns price as-is (string/number) without rounding; None if not found.
+    FIFO prices for many products in a single pass over the IGR documents
+    (each product would otherwise page through the same document list on its own).
+    FIFO price = earliest IGR price for the product (optionally filtered by bin name),
+    returned as-is (string/number) without rounding; products without an IGR map to None.
     """
+    wanted = {int(p) for p in pids}
+    if not wanted:
+        return {}
     inv_id = require_catalog_id()
     since = int(time.time()) - lookback_days * 24 * 3600
-    earliest_any = None
-    earliest_in_bin = None
+    earliest_any: Dict[int, Dict[str, Any]] = {}
+    earliest_in_bin: Dict[int, Dict[str, Any]] = {}
     page = 1
     while page <= 50:
         docs = bl_call("getInventoryDocumentsList", {
             "inventory_id": inv_id,
-            "warehouse_id": int(WAREHOUSE_ID),
+            "warehouse_id": require_warehouse_id(),
             "date_from": since,
             "page": page
         })
         rows = docs.get("documents", []) or []
         if not rows:
             break
-        for d in rows:
+        for d, doc_id, items in igr_docs_with_items(rows):
             try:
-                if int(d.get("document_type")) != 1:  # IGR only
-                    continue
-                doc_id = int(d.get("document_id"))
                 stamp = to_int(d.get("date_add") or d.get("date") or 0)
-                items = bl_call("getInventoryDocumentItems", {"document_id": doc_id})
-                for it in (items.get("items") or []):
-                    if int(it.get("product_id", 0)) != int(pid):
+                for it in items:
+                    pid = int(it.get("product_id", 0))
+                    if pid not in wanted:
                         continue
                     price = it.get("price")
                     bin_name = (it.get("location_name") or "").strip()
-                    if earliest_any is None or stamp < earliest_any["ts"]:
-                        earliest_any = {"ts": stamp, "price": price}
+                    if pid not in earliest_any or stamp < earliest_any[pid]["ts"]:
+                        earliest_any[pid] = {"ts": stamp, "price": price}
                     if location_name and bin_name == location_name:
-                        if (earliest_in_bin is None) or (stamp < earliest_in_bin["ts"]):
-                            earliest_in_bin = {"ts": stamp, "price": price}
+                        if pid not in earliest_in_bin or stamp < earliest_in_bin[pid]["ts"]:
+                            earliest_in_bin[pid] = {"ts": stamp, "price": price}
             except Exception:
                 pass
         page += 1
-    if location_name and earliest_in_bin is not None:
-        return earliest_in_bin["price"]
-    if earliest_any is not None:
-        return earliest_any["price"]
-    return None
+    out: Dict[int, Optional[str]] = {}
+    for pid in wanted:
+        if location_name and pid in earliest_in_bin:
+            out[pid] = earliest_in_bin[pid]["price"]
+        elif pid in earliest_any:
+            out[pid] = earliest_any[pid]["price"]
+        else:
+            out[pid] = None
+    return out
+
+# ==== Orders ====
+
+ORDER_LOOKBACK_DAYS = 60
+ORDER_MAX_PAGES = 300
+ORDER_PAGE_SIZE = 100  # getOrders hard limit per call
+ORDER_NUM_TTL = 24 * 3600  # order_number -> order_id never changes once assigned
+
+ORDER_RECENT_DAYS = 7     # most lookups are for fresh orders: scan this window alone first
+ORDER_SCAN_SEGMENTS = 4  # the rest of the lookback is split into date slices scanned concurrently
+
+def iter_order_pages(date_from: int, date_to: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Walk getOrders from date_from with an id_from cursor (getOrders has no page
+    parameter; each call returns up to 100 orders with order_id >= id_from).
+    With date_to, stops at the first order added at/after it (getOrders has no upper bound).
+    """
+    base = _dumps({"date_from": date_from, "get_unconfirmed_orders": True})
+    params_json = base
+    for _ in range(ORDER_MAX_PAGES):
+        rows = bl_call("getOrders", params_json=params_json).get("orders", []) or []
+        if not rows:
+            return
+        if date_to is not None:
+            keep = [o for o in rows if to_int(o.get("date_add")) < date_to]
+            if len(keep) < len(rows):
+                yield keep
+                return
+        yield rows
+        if len(rows) < ORDER_PAGE_SIZE:
+            return
+        # only the cursor changes between calls; splice it into the pre-encoded object
+        id_from = max(to_int(o.get("order_id")) for o in rows) + 1
+        params_json = f'{base[:-1]},"id_from":{id_from}}}'
+
+def _order_matches(o: Dict[str, Any], needle: str) -> bool:
+    o_num = str(o.get("order_number", "")).strip()
+    o_id  = str(o.get("order_id", "")).strip()
+    return o_num == needle if o_num else o_id == needle
+
+def _request_orders() -> Optional[Dict[str, Dict[str, Any]]]:
+    # order_id -> order, scoped to the current Flask request
+    return _request_memo("bl_orders")
+
+def get_order(oid: str) -> Optional[Dict[str, Any]]:
+    """getOrders by id (unconfirmed included); memoized for the current request."""
+    memo, key = _request_orders(), str(oid)
+    if memo is not None and key in memo:
+        return memo[key]
+    orders = bl_call("getOrders", {"order_id": key, "get_unconfirmed_orders": True}).get("orders", []) or []
+    order = orders[0] if orders else None
+    if memo is not None and order is not None:
+        memo[key] = order
+    return order
+
+def resolve_order_id(order_id: Optional[str], order_number: Optional[str], max_matches: int = 1) -> str:
+    if order_id: return str(order_id).strip()
+    if not order_number: raise ValueError("Provide order_id or order_number")
+    needle = str(order_number).strip()
+    hit = cache_get(f"ord:{needle}")
+    if hit:
+        return hit
+    # shops without custom numbering use the order_id as its number; one call settles that case
+    if needle.isdigit():
+        order = get_order(needle)
+        if order and _order_matches(order, needle):
+            cache_set(f"ord:{needle}", needle, ORDER_NUM_TTL)
+            return needle
+    now = int(time.time())
+    start = now - ORDER_LOOKBACK_DAYS * 24 * 60 * 60
+    recent = max(start, now - ORDER_RECENT_DAYS * 24 * 60 * 60)
+    step = (recent - start) // ORDER_SCAN_SEGMENTS + 1
+    older = [(start + k * step, min(start + (k + 1) * step, recent)) for k in range(ORDER_SCAN_SEGMENTS)]
+    found = threading.Event()
+
+    def scan(bounds: Tuple[int, Optional[int]]) -> List[Dict[str, Any]]:
+        out = []
+        for rows in iter_order_pages(*bounds):
+            if max_matches == 1:
+                # order numbers are unique in practice; stop reading the page at the first hit
+                hit = next((o for o in rows if _order_matches(o, needle)), None)
+                if hit is not None:
+                    out.append(hit)
+            else:
+                out += [o for o in rows if _order_matches(o, needle)]
+            if len(out) >= max_matches:
+                found.set()
+            # stop at the end of the page that yields a hit here or in another slice
+            if found.is_set():
+                break
+        return out
+
+    # recent window is open-ended so orders added mid-scan are still seen
+    matches = scan((recent, None))
+    if not matches and recent > start:
+        matches = [o for part in _POOL.map(scan, older) for o in part]
+    if not matches: raise LookupError(f"Order with order_number/id '{order_number}' not found")
+    if len(matches) > 1:
+        matches.sort(key=lambda o: (to_int(o.get("date_add")), to_int(o.get("order_id"))), reverse=True)
+    oid = str(matches[0].get("order_id"))
+    cache_set(f"ord:{needle}", oid, ORDER_NUM_TTL)
+    # the scan already returned the full order; spare the caller's get_order round-trip
+    memo = _request_orders()
+    if memo is not None:
+        memo[oid] = matches[0]
+    return oid
 
 # ==== Inventory documents ====
 
@@ -213,18 +1008,65 @@ def add_items_verbose(document_id: int, lines: List[Dict[str, Any]]) -> Tuple[Li
             except: pass
     return created, resp
 
+def add_items_batch(document_id: int, lines: List[Dict[str, Any]]) -> Tuple[List[bool], dict]:
+    """
+    Submit many lines in one addInventoryDocumentItems call.
+    Returns per-line accepted flags (aligned with `lines`) and the raw response.
+    Raises if BL rejects the call as a whole (status=ERROR, or not every line answered).
+    """
+    resp = bl_call("addInventoryDocumentItems", {"document_id": int(document_id), "items": lines})
+    items = resp.get("items")
+    if resp.get("status") == "ERROR" or not isinstance(items, list) or len(items) < len(lines):
+        raise RuntimeError(f"addInventoryDocumentItems batch rejected: "
+                           f"{resp.get('error_code') or ''} {resp.get('error_message') or ''}".strip())
+    flags = [isinstance(it, dict) and "item_id" in it for it in items]
+    return flags[:len(lines)], resp
+
 def confirm_document(document_id: int) -> None:
     bl_call("setInventoryDocumentStatusConfirmed", {"document_id": int(document_id)})
 
+LOC_TTL = 300  # seconds; bins are renamed/added rarely
+
+def _index_locations(resp: dict) -> Dict[str, str]:
+    return {str(loc.get("location_id")): (loc.get("name") or "").strip()
+            for loc in (resp.get("locations") or [])}
+
+def _get_loc_index(warehouse_id) -> Dict[str, str]:
+    """location_id -> bin name for a warehouse, refreshed every LOC_TTL seconds."""
+    wid = int(warehouse_id)
+    hit = cache_get(f"loc:{wid}")
+    if hit is not None:
+        return hit
+    if wid == _WAREHOUSE_ID_INT:
+        resp = bl_call_raw(_P_LOCATIONS)
+    else:
+        resp = bl_call("getInventoryLocations", {"warehouse_id": wid})
+    if resp.get("status") == "ERROR":
+        # BL rejects with HTTP 200; caching the empty map would fail every dst= lookup for LOC_TTL
+        raise RuntimeError(f"getInventoryLocations failed: {resp.get('error_code') or ''} "
+                           f"{resp.get('error_message') or ''}".strip())
+    idx = _index_locations(resp)
+    cache_set(f"loc:{wid}", idx, LOC_TTL)
+    return idx
+
+def prewarm_locations() -> None:
+    """Load the default warehouse's bin index ahead of traffic (gunicorn when_ready hook)."""
+    try:
+        n = len(_get_loc_index(require_warehouse_id()))
+        _cache_flush()  # persisted now, so the master has nothing left to flush at exit
+        log.info("prewarmed %d locations for warehouse %s", n, _WAREHOUSE_ID_INT)
+    except Exception:
+        log.warning("location prewarm failed; first request will load it", exc_info=True)
+    finally:
+        # runs in the master: drop the pooled keep-alive socket so forked workers
+        # don't share one TLS stream; the session reconnects on next use
+        _SESSION.close()
+
 def get_location_name_by_id(location_id: str) -> Optional[str]:
     try:
-        resp = bl_call("getInventoryLocations", {"warehouse_id": int(WAREHOUSE_ID)})
-        for loc in (resp.get("locations") or []):
-            if str(loc.get("location_id")) == str(location_id):
-                return loc.get("name")
+        return _get_loc_index(require_warehouse_id()).get(str(location_id)) or None
     except:
-        pass
-    return None
+        return None
 
 # ==== Transfer helpers (retained) ====
 
@@ -237,9 +1079,23 @@ def build_erp_line_base(pid: int, qty: int, unit: Optional[Dict[str, Any]], bin_
         if unit.get("batch"): line["batch"] = unit["batch"]
     return line
 
-def issue_unallocated(pid: int, qty: int, igi_id: int) -> Tuple[int, List[Dict[str, Any]], str]:
+def plan_erp_lines(pid: int, qty: int, units: List[Dict[str, Any]], bin_name: Optional[str] = None
+                   ) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """Split qty over ERP units (earliest expiry first) without touching BL; (line, unit) pairs."""
+    lines, remaining = [], qty
+    for u in units:
+        if remaining <= 0: break
+        take = min(remaining, to_int(u["qty"]))
+        if take <= 0: continue
+        lines.append((build_erp_line_base(pid, take, u, bin_name), u))
+        remaining -= take
+    return lines
+
+def issue_unallocated(pid: int, qty: int, igi_id: int, units: Optional[List[Dict[str, Any]]] = None) -> Tuple[int, List[Dict[str, Any]], str]:
+    # `units` is drawn down in place as BL accepts lines, so the caller's copy tracks what's left
     fails = []
-    units = get_erp_units_for_product(pid)
+    if units is None:
+        units = [dict(u) for u in get_erp_units_for_product(pid)]  # never the request memo
     if units:
         remaining, moved = qty, 0
         for u in units:
@@ -249,8 +1105,9 @@ def issue_unallocated(pid: int, qty: int, igi_id: int) -> Tuple[int, List[Dict[s
             created, raw = add_items_verbose(igi_id, [build_erp_line_base(pid, take, u)])
             if created:
                 moved += take; remaining -= take
+                u["qty"] = to_int(u["qty"]) - take
             else:
-                fails.append({"product_id": pid, "attempt_qty": take, "src": None, "erp_unit": u, "response": raw})
+                fails.append({"product_id": pid, "attempt_qty": take, "src": None, "erp_unit": dict(u), "response": raw})
                 break
         if moved:
             return moved, fails, "unallocated_with_erp"
@@ -266,9 +1123,11 @@ def issue_unallocated(pid: int, qty: int, igi_id: int) -> Tuple[int, List[Dict[s
     fails.append({"product_id": pid, "attempt_qty": qty, "src": None, "response": raw})
     return 0, fails, "unallocated_failed"
 
-def issue_from_bin(pid: int, qty: int, bin_name: str, igi_id: int) -> Tuple[int, List[Dict[str, Any]], str]:
+def issue_from_bin(pid: int, qty: int, bin_name: str, igi_id: int, units: Optional[List[Dict[str, Any]]] = None) -> Tuple[int, List[Dict[str, Any]], str]:
+    # `units` is drawn down in place as BL accepts lines, so the caller's copy tracks what's left
     fails = []
-    units = get_erp_units_for_product(pid)
+    if units is None:
+        units = [dict(u) for u in get_erp_units_for_product(pid)]  # never the request memo
     if units:
         remaining, moved = qty, 0
         for u in units:
@@ -278,8 +1137,9 @@ def issue_from_bin(pid: int, qty: int, bin_name: str, igi_id: int) -> Tuple[int,
             created, raw = add_items_verbose(igi_id, [build_erp_line_base(pid, take, u, bin_name)])
             if created:
                 moved += take; remaining -= take
+                u["qty"] = to_int(u["qty"]) - take
             else:
-                fails.append({"product_id": pid, "attempt_qty": take, "src": bin_name, "erp_unit": u, "response": raw})
+                fails.append({"product_id": pid, "attempt_qty": take, "src": bin_name, "erp_unit": dict(u), "response": raw})
                 break
         if moved:
             return moved, fails, "bin_with_erp"
@@ -295,8 +1155,99 @@ def issue_from_bin(pid: int, qty: int, bin_name: str, igi_id: int) -> Tuple[int,
     fails.append({"product_id": pid, "attempt_qty": qty, "src": bin_name, "response": raw})
     return 0, fails, "bin_failed"
 
+# ==== Request args ====
+
+_TRUTHY = frozenset({"1", "true", "yes", "on"})
+_SPLIT = re.compile(r"\s*,\s*")  # commas only: bin names may contain spaces
+
+def arg_str(args, name: str) -> str:
+    return (args.get(name) or "").strip()
+
+def arg_flag(args, name: str) -> bool:
+    return arg_str(args, name).lower() in _TRUTHY
+
+def arg_list(args, name: str) -> List[str]:
+    return [s for s in _SPLIT.split(arg_str(args, name)) if s]
+
+def arg_caps(args, name: str) -> Dict[str, int]:
+    """'binA:100,binB:50' -> {"binA": 100, "binB": 50}; entries without a number are ignored."""
+    caps = {}
+    for item in arg_list(args, name):
+        bin_name, _, num = item.rpartition(":")
+        if bin_name.strip() and num.strip().isdigit():
+            caps[bin_name.strip()] = int(num)
+    return caps
+
+@dataclass(slots=True)
+class TransferReq:
+    order_id: Optional[str]
+    order_number: Optional[str]
+    dst_loc_id: str
+    dst_name: Optional[str]
+    src_list: List[str]
+    only_skus: FrozenSet[str]  # membership-tested per order line
+    partial: bool
+    prefer_unalloc: bool
+    src_caps: Dict[str, int]
+
+def parse_transfer_args(args) -> TransferReq:
+    """Parse the transfer endpoint's query string once."""
+    return TransferReq(
+        order_id=arg_str(args, "order_id") or None,
+        order_number=arg_str(args, "order_number") or None,
+        dst_loc_id=arg_str(args, "dst"),
+        dst_name=arg_str(args, "dst_name"),
+        src_list=arg_list(args, "src_names"),
+        only_skus=frozenset(arg_list(args, "only_skus")),
+        partial=arg_flag(args, "partial"),
+        prefer_unalloc=arg_flag(args, "prefer_unallocated"),
+        src_caps=arg_caps(args, "src_caps"),
+    )
+
 # ==== ROUTES (inspect / seed / inspect_doc / probe / transfer) ====
 
+@app.get("/bl/_flush_cache")
+def flush_cache():
+    """
+    Drop cached lookups (all, or only keys starting with ?prefix=, e.g. loc:).
+    Applies here at once and in the other workers within CACHE_SYNC_EVERY seconds;
+    `flushed` counts this worker's entries only.
+    """
+    supplied = request.args.get("key") or request.headers.get("X-App-Key")
+    if SHARED_KEY and supplied != SHARED_KEY:
+        return http_error(401, "Unauthorized")
+    prefix = (request.args.get("prefix") or "").strip()
+    flushed = cache_invalidate(prefix)
+    return jsonify({"ok": True, "flushed": flushed, "prefix": prefix, "pid": os.getpid()})
+
+@app.route("/bl/warm_catalog", methods=["GET", "POST"])
+def warm_catalog():
+    """Preload sku/ean -> product_id for the whole catalog (persisted with the lookup cache)."""
+    supplied = request.args.get("key") or request.headers.get("X-App-Key")
+    if SHARED_KEY and supplied != SHARED_KEY:
+        return http_error(401, "Unauthorized")
+    try:
+        pages = to_int(request.args.get("max_pages")) or CATALOG_WARM_MAX_PAGES  # clamped in warm_catalog_ids
+        seen, complete = warm_catalog_ids(pages)
+        _cache_flush()
+        return jsonify({"ok": True, "products": seen, "complete": complete})
+    except Exception as e:
+        return internal_error(e)
+
+@app.route("/bl/reload_locations", methods=["GET", "POST"])
+def reload_locations():
+    """Refetch the bin index for a warehouse now instead of waiting out LOC_TTL."""
+    supplied = request.args.get("key") or request.headers.get("X-App-Key")
+    if SHARED_KEY and supplied != SHARED_KEY:
+        return http_error(401, "Unauthorized")
+    try:
+        wid = int(request.args.get("warehouse_id") or require_warehouse_id())
+        cache_invalidate(f"loc:{wid}")  # other workers drop theirs and reload on next use
+        idx = _get_loc_index(wid)
+        return jsonify({"ok": True, "warehouse_id": wid, "locations": len(idx), "pid": os.getpid()})
+    except Exception as e:
+        return internal_error(e)
+
 @app.get("/bl/inspect_sku")
 def inspect_sku():
     sku = (request.args.get("sku") or "").strip()
@@ -313,7 +1264,7 @@ def inspect_sku():
         erp = get_erp_units_for_product(pid)
         return jsonify({"sku": sku, "product_id": pid, "erp_units": erp})
     except Exception as e:
-        return http_error(500, "Internal error", detail=str(e))
+        return internal_error(e)
 
 @app.get("/bl/seed_erp_unit")
 def seed_erp_unit():
@@ -337,7 +1288,7 @@ def seed_erp_unit():
             return http_error(404, f"SKU {sku} not found")
         pid = rec["product_id"]
 
-        igr_id = create_document(1, int(WAREHOUSE_ID))
+        igr_id = create_document(1, require_warehouse_id())
         line = {"product_id": pid, "quantity": qty}
         if bin_name: line["location_name"] = bin_name
         if expiry:   line["expiry_date"] = expiry
@@ -360,7 +1311,7 @@ def seed_erp_unit():
             "erp_units_after": erp_units_after
         })
     except Exception as e:
-        return http_error(500, "Internal error", detail=f"{e}\n{traceback.format_exc()}")
+        return internal_error(e)
 
 @app.get("/bl/inspect_doc")
 def inspect_doc():
@@ -378,7 +1329,7 @@ def inspect_doc():
         items = bl_call("getInventoryDocumentItems", {"document_id": int(doc_id)})
         return jsonify({"doc_id": int(doc_id), "document": header, "items": items})
     except Exception as e:
-        return http_error(500, "Internal error", detail=str(e))
+        return internal_error(e)
 
 @app.get("/bl/probe_issue")
 def probe_issue():
@@ -400,7 +1351,7 @@ def probe_issue():
         erp_units = get_erp_units_for_product(pid)
         last_igr = fetch_last_igr_unit(pid)
 
-        igi_id = create_document(3, int(WAREHOUSE_ID))
+        igi_id = create_document(3, require_warehouse_id())
         attempts = []
 
         def try_line(unit=None, bin_name=None, mode=""):
@@ -428,7 +1379,7 @@ def probe_issue():
         return jsonify({"sku": sku, "product_id": pid, "erp_units_seen": erp_units,
                         "last_igr_unit": last_igr, "draft_igi_id": igi_id, "attempts": attempts})
     except Exception as e:
-        return http_error(500, "Internal error", detail=str(e))
+        return internal_error(e)
 
 @app.get("/bl/transfer_order_qty_catalog")
 def transfer_order_qty_catalog():
@@ -436,108 +1387,166 @@ def transfer_order_qty_catalog():
     if SHARED_KEY and supplied != SHARED_KEY:
         return http_error(401, "Unauthorized")
 
-    order_id_param = (request.args.get("order_id") or "").strip() or None
-    order_number   = (request.args.get("order_number") or "").strip() or None
-    dst_loc_id     = (request.args.get("dst") or "").strip()
-    dst_name       = (request.args.get("dst_name") or "").strip()
-    src_names_raw  = (request.args.get("src_names") or "").strip()
-    only_skus_raw  = (request.args.get("only_skus") or "").strip()
-    partial        = (request.args.get("partial") or "").strip().lower() in ("1","true","yes")
-    prefer_unalloc = (request.args.get("prefer_unallocated") or "").strip().lower() in ("1","true","yes")
-
-    src_list = [s.strip() for s in src_names_raw.split(",") if s.strip()] if src_names_raw else []
-    only_skus = [s.strip() for s in only_skus_raw.split(",") if s.strip()] if only_skus_raw else []
-
-    if not dst_name:
-        dst_name = get_location_name_by_id(dst_loc_id) if dst_loc_id else None
-    if not dst_name:
+    args = parse_transfer_args(request.args)
+
+    if not args.dst_name:
+        args.dst_name = get_location_name_by_id(args.dst_loc_id) if args.dst_loc_id else None
+    if not args.dst_name:
         return http_error(400, "Destination not found. Use dst_name=<bin name>.")
-    if not src_list and not prefer_unalloc:
+    if not args.src_list and not args.prefer_unalloc:
         return http_error(400, "Specify src_names or set prefer_unallocated=1")
 
-    def resolve_order_id(order_id: Optional[str], order_number: Optional[str]) -> str:
-        if order_id: return str(order_id).strip()
-        if not order_number: raise ValueError("Provide order_id or order_number")
-        needle = str(order_number).strip()
-        date_from = int(time.time()) - 60 * 24 * 60 * 60
-        matches, page = [], 1
-        while page <= 300:
-            resp = bl_call("getOrders", {"date_from": date_from, "get_unconfirmed_orders": True, "page": page})
-            rows = resp.get("orders", []) or []
-            if not rows: break
-            for o in rows:
-                o_num = str(o.get("order_number", "")).strip()
-                o_id  = str(o.get("order_id", "")).strip()
-                if (o_num and o_num == needle) or (not o_num and o_id == needle):
-                    matches.append(o)
-            page += 1
-        if not matches: raise LookupError(f"Order with order_number/id '{order_number}' not found")
-        matches.sort(key=lambda o: (to_int(o.get("date_add")), to_int(o.get("order_id"))), reverse=True)
-        return str(matches[0].get("order_id"))
-
     def get_order_by_id_strict(oid: str) -> dict:
-        resp = bl_call("getOrders", {"order_id": str(oid), "get_unconfirmed_orders": True})
-        orders = resp.get("orders", []) or []
-        if orders: return orders[0]
+        order = get_order(oid)
+        if order: return order
         raise LookupError(f"Order not found by order_id {oid}")
 
     try:
-        order_id = resolve_order_id(order_id_param, order_number)
+        order_id = resolve_order_id(args.order_id, args.order_number)
         order = get_order_by_id_strict(order_id)
         items = order.get("products", []) or []
         if not items: return http_error(400, "Order has no products")
 
-        base_lines, missing, skus_in_scope = [], [], []
+        # repeated lines for the same (sku, ean) are summed so each key is resolved and planned once
+        wanted: Dict[Tuple[str, str], int] = defaultdict(int)
         for it in items:
-            sku = (it.get("sku") or it.get("product_sku") or "").strip()
-            if only_skus and sku not in only_skus:
+            sku, ean, qty = _norm_item(it)
+            if args.only_skus and sku not in args.only_skus:
                 continue
-            qty = to_int(it.get("quantity") or it.get("qty"))
             if qty <= 0: continue
-            rec = find_catalog_product(sku=sku, include=["locations","stock"])
+            wanted[(sku, ean)] += qty
+        recs = resolve_catalog_products_bulk(list(wanted), include=["locations"])
+
+        # keyed by product_id: different (sku, ean) keys resolving to one product become one line
+        by_pid: Dict[int, Dict[str, Any]] = {}
+        missing, skus_in_scope = [], []
+        for (sku, ean), qty in wanted.items():
+            rec = recs.get((sku, ean))
             if not rec:
-                missing.append({"sku": sku, "ean": it.get("ean")})
+                missing.append({"sku": sku, "ean": ean})
                 continue
-            base_lines.append({"sku": sku, "product_id": int(rec["product_id"]), "qty": qty})
             skus_in_scope.append(sku)
+            pid = int(rec["product_id"])
+            if pid in by_pid:
+                by_pid[pid]["qty"] += qty
+                continue
+            # bins the catalog lists for this product are probed first; the map can lag,
+            # so the other requested bins stay behind them instead of being dropped
+            stocked = product_bins(rec)
+            bins = sorted(args.src_list, key=lambda b: b not in stocked) if stocked else args.src_list
+            by_pid[pid] = {"sku": sku, "product_id": pid, "qty": qty, "bins": bins}
+        base_lines = list(by_pid.values())
 
         if not base_lines:
-            return http_error(400, f"No transferrable items. Missing: {missing}, only_skus={only_skus}")
+            return http_error(400, f"No transferrable items. Missing: {missing}, only_skus={sorted(args.only_skus)}")
+
+        # one line per product, so lines never compete for ERP units; the order only decides
+        # which products draw down capped bins (src_caps) first — largest lines first
+        base_lines.sort(key=lambda l: l["qty"], reverse=True)
 
-        igi_id = create_document(3, int(WAREHOUSE_ID))
-        issued_per_product: Dict[int, int] = {}
+        igi_id = create_document(3, require_warehouse_id())
+        issued_per_product: Dict[int, int] = defaultdict(int)
         total_issued = 0
         fail_reasons: List[Dict[str, Any]] = []
         modes_used: Dict[int, str] = {}
 
-        for line in base_lines:
+        # 1) plan the first-choice ERP lines of every product and send them in one call
+        def first_bin(line: Dict[str, Any]) -> Optional[str]:
+            return None if (args.prefer_unalloc or not line["bins"]) else line["bins"][0]
+
+        # one getInventoryProductsData for every product; later per-pid lookups hit the request memo
+        erp_units = get_erp_units_bulk([l["product_id"] for l in base_lines])
+        # units still free per product: every accepted line (batch or fallback) draws these down,
+        # so a later bin or the unallocated step never reissues what an earlier one took
+        units_left = {pid: [dict(u) for u in units] for pid, units in erp_units.items()}
+
+        # src_caps: known units left per bin; bins listed there are drawn down greedily (first-fit)
+        caps = dict(args.src_caps)
+        plan_caps = dict(caps)
+        plan_lines, plan_units, plan_owner = [], [], []
+        for i, line in enumerate(base_lines):
+            src = first_bin(line)
+            want = min(line["qty"], plan_caps[src]) if src in plan_caps else line["qty"]
+            if want <= 0: continue
+            units = units_left[line["product_id"]]
+            for pl, u in plan_erp_lines(line["product_id"], want, units, src):
+                plan_lines.append(pl)
+                plan_units.append(u)
+                plan_owner.append(i)
+                if src in plan_caps:
+                    plan_caps[src] -= pl["quantity"]
+        batched_moved: Dict[int, int] = defaultdict(int)
+        answered: Set[int] = set()  # base_lines whose ERP lines got a per-line answer from the batch
+        if plan_lines:
+            try:
+                accepted, raw = add_items_batch(igi_id, plan_lines)
+            except RuntimeError as e:
+                fail_reasons.append({"batch_error": str(e), "lines": len(plan_lines)})
+            else:
+                answered.update(plan_owner)
+                for pl, u, ok, i in zip(plan_lines, plan_units, accepted, plan_owner):
+                    src = pl.get("location_name")
+                    if ok:
+                        batched_moved[i] += pl["quantity"]
+                        u["qty"] = to_int(u["qty"]) - pl["quantity"]
+                        if src in caps:
+                            caps[src] -= pl["quantity"]
+                    else:
+                        fail_reasons.append({"product_id": pl["product_id"], "attempt_qty": pl["quantity"],
+                                             "src": src, "line": pl, "response": raw})
+
+        # 2) per-line fallbacks only for what the batch didn't cover
+        for i, line in enumerate(base_lines):
             pid, remaining = line["product_id"], line["qty"]
-
-            if prefer_unalloc and remaining > 0:
-                moved, fails, mode = issue_unallocated(pid, remaining, igi_id)
+            first_src = first_bin(line)
+            first_moved = batched_moved.get(i, 0)
+            if first_moved:
+                issued_per_product[pid] += first_moved
+                total_issued += first_moved
+                remaining -= first_moved
+                modes_used[pid] = "bin_with_erp" if first_src else "unallocated_with_erp"
+            # ERP lines BL already answered in the batch aren't resent; the first step then
+            # resumes at its last-IGR/plain fallbacks (units=[])
+            units = units_left[pid]
+            first_units = [] if i in answered else units
+
+            if args.prefer_unalloc and remaining > 0 and not first_moved:
+                moved, fails, mode = issue_unallocated(pid, remaining, igi_id, units=first_units)
                 if moved:
-                    issued_per_product[pid] = issued_per_product.get(pid, 0) + moved
+                    issued_per_product[pid] += moved
                     total_issued += moved
                     remaining -= moved
                     modes_used[pid] = mode
                 fail_reasons.extend(fails)
 
-            if remaining > 0 and src_list:
-                for src in src_list:
+            if remaining > 0 and line["bins"]:
+                for j, src in enumerate(line["bins"]):
                     if remaining <= 0: break
-                    moved, fails, mode = issue_from_bin(pid, remaining, src, igi_id)
+                    capped = src in caps
+                    want = min(remaining, caps[src]) if capped else remaining
+                    if want <= 0: continue
+                    if j == 0 and first_src:
+                        if first_moved:
+                            if capped: continue  # drawn in the batch; spill into the next bins
+                            break  # first bin already issued; same as the sequential path
+                        moved, fails, mode = issue_from_bin(pid, want, src, igi_id, units=first_units)
+                    else:
+                        moved, fails, mode = issue_from_bin(pid, want, src, igi_id, units=units)
+                    if capped:
+                        caps[src] -= moved
                     if moved:
-                        issued_per_product[pid] = issued_per_product.get(pid, 0) + moved
+                        issued_per_product[pid] += moved
                         total_issued += moved
                         remaining -= moved
                         modes_used[pid] = mode
-                        break
-                    fail_reasons.extend(fails)
+                        if not capped: break
+                    else:
+                        fail_reasons.extend(fails)
 
-            if remaining > 0 and not prefer_unalloc:
-                moved, fails, mode = issue_unallocated(pid, remaining, igi_id)
+            if remaining > 0 and not args.prefer_unalloc:
+                moved, fails, mode = issue_unallocated(pid, remaining, igi_id, units=units)
                 if moved:
-                    issued_per_product[pid] = issued_per_product.get(pid, 0) + moved
+                    issued_per_product[pid] += moved
                     total_issued += moved
                     remaining -= moved
                     modes_used[pid] = mode
@@ -550,21 +1559,21 @@ def transfer_order_qty_catalog():
             ctx = {
                 "order_id": order_id,
                 "skus_in_scope": skus_in_scope,
-                "prefer_unallocated": prefer_unalloc,
-                "src_list": src_list,
+                "prefer_unallocated": args.prefer_unalloc,
+                "src_list": args.src_list,
                 "fail_reasons": fail_reasons
             }
-            return http_error(400, "IGI could not issue any items", detail=json.dumps(ctx))
+            return http_error(400, "IGI could not issue any items", detail=_dumps(ctx))
 
         confirm_document(igi_id)
 
-        igr_id = create_document(1, int(WAREHOUSE_ID))
-        igr_lines = [{"product_id": pid, "quantity": qty, "location_name": dst_name}
+        igr_id = create_document(1, require_warehouse_id())
+        igr_lines = [{"product_id": pid, "quantity": qty, "location_name": args.dst_name}
                      for pid, qty in issued_per_product.items() if qty > 0]
         created, raw = add_items_verbose(igr_id, igr_lines)
         if not created:
             fail = {"igr_add_failed": raw, "lines": igr_lines}
-            return http_error(400, "IGR failed to add items.", detail=json.dumps(fail))
+            return http_error(400, "IGR failed to add items.", detail=_dumps(fail))
         confirm_document(igr_id)
 
         return jsonify({
@@ -573,16 +1582,22 @@ def transfer_order_qty_catalog():
             "igr_document_id": igr_id,
             "moved_units": total_issued,
             "missing": missing,
-            "sources_used": src_list,
+            "sources_used": args.src_list,
             "filtered_skus": skus_in_scope,
-            "prefer_unallocated": prefer_unalloc,
+            "prefer_unallocated": args.prefer_unalloc,
             "modes_used": modes_used
         })
     except Exception as e:
-        return http_error(500, "Internal error", detail=str(e))
+        return internal_error(e)
 
 # ==== CSV Exporters ====
 
+def csv_line(row: List[Any]) -> str:
+    """One semicolon-separated CSV row, for streaming responses."""
+    buf = StringIO()
+    csv.writer(buf, delimiter=';').writerow(row)
+    return buf.getvalue()
+
 @app.get("/bl/export_order_csv")
 def export_order_csv():
     """
@@ -600,67 +1615,48 @@ def export_order_csv():
         try: return int(x or 0)
         except: return 0
 
-    def resolve_order_id(order_id: Optional[str], order_number: Optional[str]) -> str:
-        if order_id:
-            return str(order_id).strip()
-        if not order_number:
-            raise ValueError("Provide order_id or order_number")
-        needle = str(order_number).strip()
-        date_from = int(time.time()) - 60 * 24 * 60 * 60
-        matches, page = [], 1
-        while page <= 300:
-            resp = bl_call("getOrders", {"date_from": date_from, "get_unconfirmed_orders": True, "page": page})
-            rows = resp.get("orders", []) or []
-            if not rows: break
-            for o in rows:
-                o_num = str(o.get("order_number", "")).strip()
-                o_id  = str(o.get("order_id", "")).strip()
-                if (o_num and o_num == needle) or (not o_num and o_id == needle):
-                    matches.append(o)
-            page += 1
-        if not matches:
-            raise LookupError(f"Order with order_number/id '{order_number}' not found")
-        matches.sort(key=lambda o: (to_int_local(o.get("date_add")), to_int_local(o.get("order_id"))), reverse=True)
-        return str(matches[0].get("order_id"))
-
     try:
         oid = resolve_order_id(order_id_param, order_number)
-        order_resp = bl_call("getOrders", {"order_id": oid, "get_unconfirmed_orders": True})
-        orders = order_resp.get("orders", []) or []
-        if not orders:
+        order = get_order(oid)
+        if not order:
             return http_error(404, f"Order not found: {oid}")
-        order = orders[0]
 
         lines = order.get("products", []) or []
         if not lines:
             return http_error(400, "Order has no products")
 
-        buf = StringIO()
-        writer = csv.writer(buf, delimiter=';')
-        writer.writerow(["SKU", "Quantity", "Purchase price", "Location"])
-
-        for it in lines:
-            sku = (it.get("sku") or it.get("product_sku") or "").strip()
-            qty = to_int_local(it.get("quantity") or it.get("qty"))
-
-            price_str = ""
-            if sku:
-                rec = find_catalog_product(sku=sku)
-                if rec:
-                    pid = int(rec["product_id"])
-                    fifo_price = fetch_fifo_cost(pid, location_name=default_loc)
-                    if fifo_price is not None and fifo_price != "":
-                        price_str = str(fifo_price)
-
-            writer.writerow([sku, qty, price_str, default_loc])
-
-        resp = make_response(buf.getvalue())
-        resp.headers["Content-Type"] = "text/csv; charset=utf-8"
+        # resolve every SKU concurrently up front; the loop below only reads the result
+        skus = {(it.get("sku") or it.get("product_sku") or "").strip() for it in lines}
+        recs = resolve_catalog_products_bulk([(sku, "") for sku in skus if sku])
+
+        # one document scan prices every product; done before the 200 so BL failures still hit internal_error
+        prices = fetch_fifo_costs([int(rec["product_id"]) for rec in recs.values() if rec],
+                                  location_name=default_loc)
+
+        # the generator only formats; nothing in it talks to BL
+        def rows() -> Iterator[str]:
+            yield csv_line(["SKU", "Quantity", "Purchase price", "Location"])
+            for it in lines:
+                sku = (it.get("sku") or it.get("product_sku") or "").strip()
+                qty = to_int_local(it.get("quantity") or it.get("qty"))
+
+                price_str = ""
+                if sku:
+                    rec = recs.get((sku, ""))
+                    if rec:
+                        pid = int(rec["product_id"])
+                        fifo_price = prices.get(pid)
+                        if fifo_price is not None and fifo_price != "":
+                            price_str = str(fifo_price)
+
+                yield csv_line([sku, qty, price_str, default_loc])
+
+        resp = Response(rows(), content_type="text/csv; charset=utf-8")
         resp.headers["Content-Disposition"] = f"attachment; filename=order_{oid}_for_transfer.csv"
         return resp
 
     except Exception as e:
-        return http_error(500, "Internal error", detail=f"{e}\n{traceback.format_exc()}")
+        return internal_error(e)
 
 @app.get("/bl/export_order_csv_v2")
 def export_order_csv_v2():
@@ -681,69 +1677,48 @@ def export_order_csv_v2():
         try: return int(x or 0)
         except: return 0
 
-    def resolve_order_id(order_id: Optional[str], order_number: Optional[str]) -> str:
-        if order_id:
-            return str(order_id).strip()
-        if not order_number:
-            raise ValueError("Provide order_id or order_number")
-        needle = str(order_number).strip()
-        date_from = int(time.time()) - 60 * 24 * 60 * 60
-        matches, page = [], 1
-        while page <= 300:
-            resp = bl_call("getOrders", {"date_from": date_from, "get_unconfirmed_orders": True, "page": page})
-            rows = resp.get("orders", []) or []
-            if not rows: break
-            for o in rows:
-                o_num = str(o.get("order_number", "")).strip()
-                o_id  = str(o.get("order_id", "")).strip()
-                if (o_num and o_num == needle) or (not o_num and o_id == needle):
-                    matches.append(o)
-            page += 1
-        if not matches:
-            raise LookupError(f"Order with order_number/id '{order_number}' not found")
-        matches.sort(key=lambda o: (to_int_local(o.get("date_add")), to_int_local(o.get("order_id"))), reverse=True)
-        return str(matches[0].get("order_id"))
-
     try:
         oid = resolve_order_id(order_id_param, order_number)
-        order_resp = bl_call("getOrders", {"order_id": oid, "get_unconfirmed_orders": True})
-        orders = order_resp.get("orders", []) or []
-        if not orders:
+        order = get_order(oid)
+        if not order:
             return http_error(404, f"Order not found: {oid}")
-        order = orders[0]
 
         lines = order.get("products", []) or []
         if not lines:
             return http_error(400, "Order has no products")
 
+        # resolve every SKU concurrently up front; fifo_price_for_sku only reads the result
+        skus = {(it.get("sku") or it.get("product_sku") or "").strip() for it in lines}
+        recs = resolve_catalog_products_bulk([(sku, "") for sku in skus if sku])
+        # one document scan prices every product; done before the 200 so BL failures still hit internal_error
+        prices = fetch_fifo_costs([int(rec["product_id"]) for rec in recs.values() if rec],
+                                  location_name=default_loc)
+
         def fifo_price_for_sku(sku: str) -> Optional[str]:
-            rec = find_catalog_product(sku=sku)
+            rec = recs.get((sku, ""))
             if not rec:
                 return None
-            pid = int(rec["product_id"])
-            return fetch_fifo_cost(pid, location_name=default_loc)
-
-        buf = StringIO()
-        writer = csv.writer(buf, delimiter=';')
-        writer.writerow(["SKU", "Quantity", "Purchase price", "Location"])
-
-        for it in lines:
-            sku = (it.get("sku") or it.get("product_sku") or "").strip()
-            qty = to_int_local(it.get("quantity") or it.get("qty"))
-            price_str = ""
-            if sku:
-                p = fifo_price_for_sku(sku)
-                if p is not None and p != "":
-                    price_str = str(p)  # no rounding
-            writer.writerow([sku, qty, price_str, default_loc])
-
-        resp = make_response(buf.getvalue())
-        resp.headers["Content-Type"] = "text/csv; charset=utf-8"
+            return prices.get(int(rec["product_id"]))
+
+        # the generator only formats; nothing in it talks to BL
+        def rows() -> Iterator[str]:
+            yield csv_line(["SKU", "Quantity", "Purchase price", "Location"])
+            for it in lines:
+                sku = (it.get("sku") or it.get("product_sku") or "").strip()
+                qty = to_int_local(it.get("quantity") or it.get("qty"))
+                price_str = ""
+                if sku:
+                    p = fifo_price_for_sku(sku)
+                    if p is not None and p != "":
+                        price_str = str(p)  # no rounding
+                yield csv_line([sku, qty, price_str, default_loc])
+
+        resp = Response(rows(), content_type="text/csv; charset=utf-8")
         resp.headers["Content-Disposition"] = f"attachment; filename=order_{oid}_for_transfer_v2.csv"
         return resp
 
     except Exception as e:
-        return http_error(500, "Internal error", detail=f"{e}\n{traceback.format_exc()}")
+        return internal_error(e)
 
 # ---- dev server entrypoint (so `python app.py` works too) ----
 if __name__ == "__main__":
@@ -0,0 +1,15 @@
+# gunicorn picks this file up from the working directory; env vars override per deploy
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+worker_class = "gevent"  # BL calls are I/O-bound; greenlets overlap them across clients
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", "100"))  # matches _SESSION pool_maxsize
+timeout = 30
+preload_app = True
+
+
+def when_ready(server):
+    # with preload_app the module is already imported; workers fork with the bin index loaded
+    import app
+    app.prewarm_locations()